@@ -1,21 +1,62 @@
 import httpx
 import asyncio
+import orjson
+import numpy as np
+from cachetools import LRUCache, TTLCache
 import time
-from fastapi import FastAPI, HTTPException, status, Depends # 💡 Depends added
+import gzip
+import hmac
+import hashlib
+from email.utils import formatdate
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response, status, Depends # 💡 Depends added
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import APIKeyHeader # 💡 New import
-from typing import Dict, Any, List
+from starlette.datastructures import Headers
+from typing import Dict, Any, List, Literal
 import os
+import re
+import logging
 
 import uvicorn
 
+# uvloop replaces the default asyncio loop with a libuv-based one (ships with uvicorn[standard]).
+# uvicorn selects it through its loop setting (see __main__); it is not available on Windows,
+# so fall back to the stdlib loop there.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Redis is optional: it is only needed when REDIS_URL is set (shared cache across workers/pods).
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# Brotli is optional: without it the aggregated payload is only offered gzip-compressed.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # =================================================================
 #                         CONFIGURATION
 # =================================================================
 
+# --- LOGGING ---
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # httpx logs every request at INFO
+
 # --- SECURITY ---
 API_KEY_SECRET = os.getenv('CRYPTO_API_KEY') 
 API_KEY_HEADER = "X-API-Key" 
+API_KEY_BYTES = (API_KEY_SECRET or "").encode()  # Encoded once for constant-time comparison
 
 # --- External APIs ---
 BYBIT_API_BASE_URL = "https://api.bybit.com"
@@ -23,6 +64,7 @@ BYBIT_API_BASE_URL = "https://api.bybit.com"
 # Bybit Endpoints
 TICKERS_ENDPOINT = "/v5/market/tickers"  # For current prices
 KLINE_ENDPOINT = "/v5/market/kline"    # ENDPOINT for Candlestick data
+TICKER_FIELDS = ("lastPrice", "price24hPcnt", "volume24h")  # Ticker fields used by aggregate_data
 
 COINGECKO_API_URL = "https://api.coingecko.com/api/v3/coins/markets"
 COINGECKO_PARAMS = {
@@ -31,34 +73,154 @@ COINGECKO_PARAMS = {
     'page': 1,
     'sparkline': False,
 }
+COINGECKO_PAGES = 4  # Pages fetched in parallel (4 x 250 = top 1000 coins by market cap)
+
+# --- HTTP Client (shared, pooled) ---
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60)
+
+# Rate-limited (429) and upstream server errors (5xx) are retried with exponential backoff
+UPSTREAM_RETRIES = 2
+UPSTREAM_BACKOFF_SECONDS = 0.5
 
 # --- CACHING Parameters ---
 CACHE_DURATION_SECONDS = 300  
+CACHE_RETRY_SECONDS = 30       # Retry interval for the background refresher after a failed refresh
+COLD_START_WAIT_SECONDS = 10   # Longest a request waits for the first refresh before a 503
 data_cache = {
     "last_updated": 0,       
-    "data": {}               
+    "last_failed": 0,        # Time of the last failed refresh attempt
+    "payload": b"",          # Aggregated data serialized to JSON once per refresh
+    "encoded": {},           # "payload" compressed once per refresh, keyed by Content-Encoding
+    "etag": "",              # Hash of "payload", for conditional requests
+    "last_modified": ""      # "last_updated" as an HTTP date
+}
+
+# --- SHARED CACHE (Redis, optional) ---
+# With REDIS_URL set, the aggregated payload is shared by every worker and pod: one of them
+# refreshes it from the external APIs (elected with SET NX EX), the others read it from Redis.
+REDIS_URL = os.getenv('REDIS_URL')
+REDIS_CACHE_KEY = "mkt:aggregated"
+REDIS_LOCK_KEY = "mkt:lock"
+REDIS_LOCK_SECONDS = 30      # Refresh lock lifetime, also how long followers wait for the leader
+REDIS_POLL_SECONDS = 0.5     # How often followers check for the leader's payload
+REDIS_TIMEOUT_SECONDS = 2    # Connect/command timeout, so a hung Redis falls back to direct upstream
+
+# --- COMPRESSION Parameters ---
+GZIP_MINIMUM_SIZE = 1024     # Responses smaller than this are not worth compressing
+BROTLI_QUALITY = 4
+
+# USDT pairs derived from the last seen Bybit symbol universe (see get_usdt_pairs)
+symbol_index = {
+    "symbols": frozenset(),
+    "usdt_pairs": {}
+}
+
+# --- KLINE CACHING Parameters ---
+# Candles that are still forming change constantly, so they are only cached briefly.
+# Fully closed ranges are immutable and can stay in an LRU until evicted.
+# Entries hold every response format of one upstream request ({format: bytes}), and both
+# caches are bounded by the total size of those payloads (bytes), per worker.
+KLINE_CACHE_TTL_SECONDS = 5
+KLINE_LIVE_CACHE_BYTES = 16 * 1024 * 1024
+KLINE_HISTORY_CACHE_BYTES = 64 * 1024 * 1024
+kline_payloads_size = lambda payloads: sum(len(payload) for payload in payloads.values())
+kline_live_cache = TTLCache(maxsize=KLINE_LIVE_CACHE_BYTES, ttl=KLINE_CACHE_TTL_SECONDS, getsizeof=kline_payloads_size)
+kline_history_cache = LRUCache(maxsize=KLINE_HISTORY_CACHE_BYTES, getsizeof=kline_payloads_size)
+
+# Upstream kline requests currently in flight, keyed by request parameters
+kline_inflight: Dict[tuple, asyncio.Task] = {}
+
+# Column names of a Bybit kline row, in order
+KLINE_COLUMNS = ("ts", "open", "high", "low", "close", "volume", "turnover")
+
+# Candle length in milliseconds per Bybit interval ('M' uses the longest month)
+KLINE_INTERVAL_MS = {
+    **{m: int(m) * 60_000 for m in ("1", "3", "5", "15", "30", "60", "120", "240", "360", "720")},
+    "D": 86_400_000,
+    "W": 7 * 86_400_000,
+    "M": 31 * 86_400_000,
 }
 
+# --- KLINE Request Validation (checked before any upstream call) ---
+KLINE_INTERVALS = frozenset(KLINE_INTERVAL_MS)
+KLINE_MAX_LIMIT = 1000
+SYMBOL_PATTERN = re.compile(r"^[A-Z0-9]{4,30}$")
+
 # =================================================================
 #                         FASTAPI SETUP
 # =================================================================
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Creates one pooled HTTP/2 client for the lifetime of the app, so keep-alive
+    connections to Bybit and CoinGecko are reused instead of re-handshaking per request.
+    Also connects to Redis when configured and starts the background task that keeps
+    the aggregated cache warm.
+    """
+    app.state.client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    app.state.refresh_task = None
+    app.state.redis = None
+    if REDIS_URL:
+        if aioredis is None:
+            raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed.")
+        app.state.redis = aioredis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT_SECONDS,
+            socket_connect_timeout=REDIS_TIMEOUT_SECONDS
+        )
+    refresher = asyncio.create_task(refresh_loop(app))
+    try:
+        yield
+    finally:
+        refresher.cancel()
+        if app.state.refresh_task is not None:
+            app.state.refresh_task.cancel()
+        try:
+            await refresher
+        except asyncio.CancelledError:
+            pass
+        await app.state.client.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
+
 app = FastAPI(
     title="Crypto Investment Data Aggregator",
     description="Aggregates CoinGecko and Bybit data with server-side caching and API Key protection.",
-    version="2.1.0"
+    version="2.1.0",
+    lifespan=lifespan
 )
 
 # --- CORS Configuration ---
-origins = ["*"]  
+# Browser origins allowed to call the API (comma-separated in CORS_ORIGINS, e.g.
+# "https://app.example.com,http://localhost:5173"). Authentication uses the X-API-Key header,
+# not cookies, so credentials are not allowed; the API only serves GET requests.
+origins = [origin.strip() for origin in os.getenv('CORS_ORIGINS', '*').split(',') if origin.strip()]
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_credentials=False,
+    allow_methods=["GET"],
+    allow_headers=[API_KEY_HEADER, "Content-Type"],
 )
 
+# --- Compression for dynamic responses (klines); the aggregated payload is pre-compressed ---
+class AcceptEncodingGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that parses Accept-Encoding properly: Starlette's only looks for the
+    substring "gzip", so it would also compress for "gzip;q=0", which refuses gzip.
+    """
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" not in accepted_encodings(Headers(scope=scope).get("accept-encoding", "")):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(AcceptEncodingGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
 # =================================================================
 #                       API KEY VALIDATION FUNCTION
 # =================================================================
@@ -70,8 +232,9 @@ async def verify_api_key(api_key: str = Depends(api_key_header)):
     """
     Checks if the provided API key matches the secret key.
     Requires the 'X-API-Key' header to be present.
+    The comparison is constant-time, and every key is rejected if no secret is configured.
     """
-    if api_key is None or api_key != API_KEY_SECRET:
+    if not api_key or not API_KEY_BYTES or not hmac.compare_digest(api_key.encode(), API_KEY_BYTES):
         # 401 Unauthorized if the key is invalid or missing
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -84,54 +247,114 @@ async def verify_api_key(api_key: str = Depends(api_key_header)):
 #                       DATA FETCHING FUNCTIONS
 # =================================================================
 
+async def fetch_json(client: httpx.AsyncClient, url: str, params: Dict[str, Any], source: str) -> Any:
+    """
+    GETs a URL and decodes the JSON body. Returns None on any failure.
+    429 and 5xx responses are retried up to UPSTREAM_RETRIES times with exponential backoff;
+    other 4xx responses, timeouts and network errors give up immediately.
+    """
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        try:
+            response = await client.get(url, params=params)
+        except httpx.TimeoutException:
+            logger.warning("%s request timed out", source)
+            return None
+        except httpx.HTTPError as e:
+            logger.warning("%s network error: %s", source, e.__class__.__name__)
+            return None
+
+        status_code = response.status_code
+        if status_code < 400:
+            try:
+                return orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                logger.warning("%s returned invalid JSON", source)
+                return None
+
+        if status_code != 429 and status_code < 500:
+            logger.warning("%s HTTP error: %s", source, status_code)
+            return None
+
+        if attempt < UPSTREAM_RETRIES:
+            backoff = UPSTREAM_BACKOFF_SECONDS * 2 ** attempt
+            logger.info("%s HTTP %s, retrying in %.1fs", source, status_code, backoff)
+            await asyncio.sleep(backoff)
+
+    logger.warning("%s HTTP error: %s after %d attempts", source, status_code, UPSTREAM_RETRIES + 1)
+    return None
+
+
+async def fetch_coingecko_page(client: httpx.AsyncClient, page: int) -> List[Dict[str, Any]]:
+    """Fetches one page of CoinGecko market data. A failed page returns an empty list."""
+    data = await fetch_json(client, COINGECKO_API_URL, {**COINGECKO_PARAMS, 'page': page}, f"CoinGecko page {page}")
+    if not isinstance(data, list):
+        return []
+    return data
+
+
 async def fetch_coingecko_data(client: httpx.AsyncClient) -> Dict[str, Any]:
-    """Fetches CoinGecko data (Market Cap, Rank, LOGO)"""
-    try:
-        response = await client.get(COINGECKO_API_URL, params=COINGECKO_PARAMS, timeout=10)
-        response.raise_for_status()
-        raw_data = response.json()
-        
-        # Convert list to dictionary for fast access by symbol (BTC, ETH)
-        coingecko_map = {}
-        for coin in raw_data:
-            symbol = coin.get('symbol', '').upper()
-            if symbol:
-                coingecko_map[symbol] = {
-                    "marketCapUSD": coin.get('market_cap'),
-                    "marketCapRank": coin.get('market_cap_rank'),
-                    "coinName": coin.get('name'),
-                    "coinLogoURL": coin.get('image')
-                }
-        return coingecko_map
-    except Exception as e:
-        print(f"CoinGecko Error during fetch: {e.__class__.__name__}. Returning empty data.")
-        return {}
+    """Fetches CoinGecko data (Market Cap, Rank, LOGO), all pages in parallel"""
+    pages = await asyncio.gather(
+        *(fetch_coingecko_page(client, page) for page in range(1, COINGECKO_PAGES + 1))
+    )
+    raw_data = [coin for page in pages for coin in page]
+
+    # Convert list to dictionary for fast access by symbol (BTC, ETH).
+    # Iterated in reverse rank order so the higher-ranked coin wins when tickers collide.
+    return {
+        coin['symbol'].upper(): {
+            "marketCapUSD": coin.get('market_cap'),
+            "marketCapRank": coin.get('market_cap_rank'),
+            "coinName": coin.get('name'),
+            "coinLogoURL": coin.get('image')
+        }
+        for coin in reversed(raw_data) if coin.get('symbol')
+    }
 
 
 async def fetch_bybit_spot_tickers(client: httpx.AsyncClient) -> Dict[str, Any]:
     """Fetches current ticker data from Bybit (Price, Volume, % Change)"""
     url = BYBIT_API_BASE_URL + TICKERS_ENDPOINT
     params = {'category': 'spot'}
-    
+
+    data = await fetch_json(client, url, params, "Bybit tickers")
+    if not isinstance(data, dict):
+        return {}
+
+    if data.get('retCode') != 0:
+        logger.warning("Bybit API Error: %s", data.get('retMsg', 'Unknown API error'))
+        return {}
+
     try:
-        response = await client.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get('retCode') == 0:
-            # Create Bybit dictionary (symbol: data)
-            return {item['symbol']: item for item in data['result']['list']}
-        else:
-            print(f"Bybit API Error: {data.get('retMsg', 'Unknown API error')}")
-            return {}
-    except Exception as e:
-        print(f"Bybit Network Error during fetch: {e.__class__.__name__}. Returning empty data.")
+        # Create Bybit dictionary (symbol: data), in one pass over the parsed list and keeping
+        # only the fields aggregate_data reads, so the rest of the payload is freed right away
+        return {
+            item['symbol']: {field: item.get(field) for field in TICKER_FIELDS}
+            for item in data['result']['list']
+        }
+    except (KeyError, TypeError):
+        logger.warning("Bybit tickers response has an unexpected shape")
         return {}
 
 
 async def fetch_bybit_klines(client: httpx.AsyncClient, symbol: str, interval: str, start_time: int = None, end_time: int = None, limit: int = 1000) -> List[List[str]]:
     """
     Fetches candlestick data (OHLCV) from Bybit.
+    Concurrent calls with identical parameters share a single upstream request.
+    """
+    key = (symbol, interval, start_time, end_time, limit)
+    task = kline_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(request_bybit_klines(client, symbol, interval, start_time, end_time, limit))
+        kline_inflight[key] = task
+        task.add_done_callback(lambda _: kline_inflight.pop(key, None))
+    # Shielded so one caller disconnecting does not cancel the request for the others
+    return await asyncio.shield(task)
+
+
+async def request_bybit_klines(client: httpx.AsyncClient, symbol: str, interval: str, start_time: int = None, end_time: int = None, limit: int = 1000) -> List[List[str]]:
+    """
+    Requests candlestick data (OHLCV) from Bybit.
     start_time and end_time must be in milliseconds.
     """
     url = BYBIT_API_BASE_URL + KLINE_ENDPOINT
@@ -150,104 +373,358 @@ async def fetch_bybit_klines(client: httpx.AsyncClient, symbol: str, interval: s
     if end_time:
         params['end'] = end_time
 
-    try:
-        response = await client.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        if data.get('retCode') == 0 and data['result']['list']:
-            # Bybit returns a list of lists [timestamp, open, high, low, close, volume, turnover]
-            return data['result']['list']
-        else:
-            ret_msg = data.get('retMsg', 'Unknown API error')
-            print(f"Bybit Kline API Error for {symbol}/{interval}: {ret_msg}")
-            return []
-            
-    except httpx.HTTPStatusError as e:
-        print(f"Bybit Kline HTTP Error for {symbol}/{interval}: {e.response.status_code}")
+    data = await fetch_json(client, url, params, f"Bybit Kline {symbol}/{interval}")
+    if not isinstance(data, dict):
+        return []
+
+    if data.get('retCode') != 0:
+        logger.warning("Bybit Kline API Error for %s/%s: %s", symbol, interval, data.get('retMsg', 'Unknown API error'))
         return []
-    except Exception as e:
-        print(f"Bybit Kline Network Error for {symbol}/{interval}: {e.__class__.__name__}")
+
+    result = data.get('result')
+    klines = result.get('list') if isinstance(result, dict) else None
+    if not isinstance(klines, list):
+        logger.warning("Bybit Kline response for %s/%s has an unexpected shape", symbol, interval)
         return []
 
+    # Bybit returns a list of lists [timestamp, open, high, low, close, volume, turnover]
+    return klines
+
+
+def get_usdt_pairs(bybit_data: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Returns {symbol: base_coin} for the USDT pairs in the Bybit data (e.g. 'BTCUSDT' -> 'BTC').
+    The mapping is only rebuilt when the set of Bybit symbols changes, which is rare.
+    """
+    symbols = bybit_data.keys()
+    if symbols != symbol_index["symbols"]:
+        symbol_index["usdt_pairs"] = {
+            symbol: symbol[:-4] for symbol in symbols if symbol.endswith('USDT')
+        }
+        symbol_index["symbols"] = frozenset(symbols)
+    return symbol_index["usdt_pairs"]
+
 
 def aggregate_data(coingecko_data: Dict[str, Any], bybit_data: Dict[str, Any]) -> Dict[str, Any]:
     """Merges and filters data from both sources."""
     final_data = {}
-    
-    for symbol, bb_item in bybit_data.items():
-        # Filter only USDT pairs for investment purposes
-        if not symbol.endswith('USDT'):
-            continue
-            
-        # Extract the base coin (e.g., 'BTCUSDT' -> 'BTC')
-        base_coin = symbol.replace('USDT', '')
-        cg_item = coingecko_data.get(base_coin)
-        
+    get_cg_item = coingecko_data.get  # bound once, called per symbol
+    empty = {}
+
+    # Only USDT pairs are kept for investment purposes
+    for symbol, base_coin in get_usdt_pairs(bybit_data).items():
+        bb_item = bybit_data[symbol]
+        cg_item = get_cg_item(base_coin) or empty
+
         # Construct the final data structure
         final_data[symbol] = {
-            "coinName": cg_item.get('coinName', base_coin) if cg_item else base_coin,
+            "coinName": cg_item.get('coinName', base_coin),
             "currentPrice": bb_item.get('lastPrice'),
             "priceChange24hPcnt": bb_item.get('price24hPcnt'),
             "volume24h": bb_item.get('volume24h'),
-            "coinLogoURL": cg_item.get('coinLogoURL') if cg_item else None,
+            "coinLogoURL": cg_item.get('coinLogoURL'),
             # Long-term metrics from CoinGecko:
-            "marketCapUSD": cg_item.get('marketCapUSD') if cg_item else None,
-            "marketCapRank": cg_item.get('marketCapRank') if cg_item else None
+            "marketCapUSD": cg_item.get('marketCapUSD'),
+            "marketCapRank": cg_item.get('marketCapRank')
         }
-        
+
+    return final_data
+
+def to_float(value: Any) -> float:
+    """Parses an upstream numeric string, mapping missing or malformed values to NaN."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def klines_to_columns(klines: List[List[str]]) -> Dict[str, np.ndarray]:
+    """
+    Converts Bybit kline rows (lists of numeric strings) into one float64 array per column,
+    e.g. {"ts": [...], "open": [...], ...}, for vectorized consumers.
+    """
+    width = len(KLINE_COLUMNS)
+    try:
+        arr = np.array(klines, dtype=np.float64)
+        if arr.ndim != 2 or arr.shape[1] < width:
+            raise ValueError("unexpected kline row shape")
+    except ValueError:
+        # Malformed or short rows: parse value by value, mapping bad/missing values to NaN
+        arr = np.array(
+            [[to_float(row[i]) if i < len(row) else float("nan") for i in range(width)] for row in klines],
+            dtype=np.float64
+        )
+    # Transposed into C-contiguous rows: orjson only serializes contiguous arrays
+    cols = np.ascontiguousarray(arr[:, :width].T)
+    return {name: cols[i] for i, name in enumerate(KLINE_COLUMNS)}
+
+
+def serialize_klines(klines: List[List[str]]) -> Dict[str, bytes]:
+    """Serializes kline rows once into every response format of the klines endpoint."""
+    return {
+        "rows": orjson.dumps(klines),
+        "columnar": orjson.dumps(klines_to_columns(klines), option=orjson.OPT_SERIALIZE_NUMPY)
+    }
+
+
+def select_kline_cache(interval: str, end_time: int = None):
+    """
+    Picks the cache for a kline request: the history LRU if the last candle in the
+    range has already closed, otherwise the short-lived TTL cache.
+    """
+    interval_ms = KLINE_INTERVAL_MS.get(interval)
+    if end_time and interval_ms and end_time + interval_ms <= time.time() * 1000:
+        return kline_history_cache
+    return kline_live_cache
+
+# =================================================================
+#                   RESPONSE COMPRESSION & CACHE HEADERS
+# =================================================================
+
+def compress_payload(payload: bytes) -> Dict[str, bytes]:
+    """Compresses a payload once into every supported Content-Encoding (best first)."""
+    if len(payload) < GZIP_MINIMUM_SIZE:
+        return {}
+    encoded = {}
+    if brotli:
+        encoded["br"] = brotli.compress(payload, quality=BROTLI_QUALITY)
+    encoded["gzip"] = gzip.compress(payload)
+    return encoded
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """Parses an Accept-Encoding header into the set of codings the client accepts (q > 0)."""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+    return accepted
+
+
+def payload_etag(payload: bytes) -> str:
+    """
+    ETag of a payload. Weak, because the same ETag is served for every Content-Encoding
+    of the payload, whose bytes differ but whose content is identical.
+    """
+    return f'W/"{hashlib.blake2b(payload, digest_size=8).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """True if an If-None-Match header matches the ETag (weak comparison)."""
+    opaque_tag = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == opaque_tag:
+            return True
+    return False
+
+
+def cached_payload_response(request: Request) -> Response:
+    """
+    Builds the aggregated response, picking a pre-compressed variant the client accepts.
+    Clients (and their caches) may reuse it until the cache expires, and a repeated request
+    whose If-None-Match holds the current ETag gets an empty 304.
+    """
+    max_age = int(max(0, CACHE_DURATION_SECONDS - (time.time() - data_cache["last_updated"])))
+    headers = {
+        "ETag": data_cache["etag"],
+        "Last-Modified": data_cache["last_modified"],
+        # private: the data is behind the API key, so shared caches must not serve it to others
+        "Cache-Control": f"private, max-age={max_age}",
+        "Vary": "Accept-Encoding"
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), data_cache["etag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    for coding, body in data_cache["encoded"].items():
+        if coding in accepted:
+            return Response(
+                content=body,
+                media_type="application/json",
+                headers={**headers, "Content-Encoding": coding}
+            )
+    return Response(content=data_cache["payload"], media_type="application/json", headers=headers)
+
+# =================================================================
+#                       CACHE REFRESH (SINGLE-FLIGHT)
+# =================================================================
+
+def is_cache_fresh(current_time: float) -> bool:
+    """True if the cache holds data younger than CACHE_DURATION_SECONDS."""
+    return bool(data_cache["payload"]) and (current_time - data_cache["last_updated"] < CACHE_DURATION_SECONDS)
+
+
+def store_payload(payload: bytes, updated_at: float):
+    """Installs a serialized aggregated payload (and everything derived from it) in the local cache."""
+    data_cache["encoded"] = compress_payload(payload)
+    data_cache["etag"] = payload_etag(payload)
+    data_cache["payload"] = payload
+    data_cache["last_updated"] = updated_at
+    data_cache["last_modified"] = formatdate(updated_at, usegmt=True)
+
+
+async def fetch_aggregated_data(client: httpx.AsyncClient) -> Dict[str, Any]:
+    """Fetches both external sources in parallel and aggregates them."""
+    logger.info("Refreshing data from external APIs...")
+    coingecko_data, bybit_data = await asyncio.gather(
+        fetch_coingecko_data(client),
+        fetch_bybit_spot_tickers(client)
+    )
+    final_data = aggregate_data(coingecko_data, bybit_data)
+    logger.info("Aggregated data from external APIs. Total coins: %d", len(final_data))
     return final_data
 
+
+async def refresh_from_upstream(app: FastAPI) -> bool:
+    """Refreshes the local cache directly from the external APIs."""
+    current_time = time.time()
+    final_data = await fetch_aggregated_data(app.state.client)
+    if not final_data:
+        return False
+    store_payload(orjson.dumps(final_data), current_time)
+    return True
+
+
+async def refresh_from_redis(app: FastAPI, wait_for_leader: bool = True) -> bool:
+    """
+    Refreshes the local cache from the payload shared in Redis.
+    If it has expired, the worker that wins REDIS_LOCK_KEY rebuilds it from the external APIs
+    and stores it with SETEX. The others poll until it appears or the lock expires when
+    wait_for_leader is set (background refresher), or give up at once (request handlers).
+    The lock is never released early, so while the APIs are failing the whole fleet
+    makes at most one upstream attempt per REDIS_LOCK_SECONDS.
+    """
+    redis = app.state.redis
+    deadline = time.monotonic() + REDIS_LOCK_SECONDS
+    while True:
+        async with redis.pipeline(transaction=False) as pipe:
+            payload, ttl_ms = await pipe.get(REDIS_CACHE_KEY).pttl(REDIS_CACHE_KEY).execute()
+        if payload:
+            # Back-date the local copy so it expires together with the shared one
+            age = CACHE_DURATION_SECONDS - max(ttl_ms, 0) / 1000
+            store_payload(payload, time.time() - age)
+            return True
+
+        if await redis.set(REDIS_LOCK_KEY, "1", nx=True, ex=REDIS_LOCK_SECONDS):
+            current_time = time.time()
+            final_data = await fetch_aggregated_data(app.state.client)
+            if not final_data:
+                return False
+            payload = orjson.dumps(final_data)
+            await redis.set(REDIS_CACHE_KEY, payload, ex=CACHE_DURATION_SECONDS)
+            store_payload(payload, current_time)
+            return True
+
+        if not wait_for_leader:
+            return False
+        if time.monotonic() >= deadline:
+            logger.warning("Timed out waiting for another worker to refresh the shared cache.")
+            return False
+        await asyncio.sleep(REDIS_POLL_SECONDS)
+
+
+async def run_refresh(app: FastAPI, wait_for_leader: bool) -> bool:
+    """Runs one refresh of the aggregated cache, through Redis when configured."""
+    if app.state.redis is None:
+        refreshed = await refresh_from_upstream(app)
+    else:
+        try:
+            refreshed = await refresh_from_redis(app, wait_for_leader)
+        except aioredis.RedisError as e:
+            logger.warning("Redis unavailable (%s). Refreshing from external APIs directly.", e.__class__.__name__)
+            refreshed = await refresh_from_upstream(app)
+
+    if not refreshed:
+        data_cache["last_failed"] = time.time()
+        logger.warning("Failed to refresh. Keeping previous cache contents.")
+        return False
+
+    logger.info("Cache successfully updated.")
+    return True
+
+
+async def refresh_aggregated_data(app: FastAPI, wait_for_leader: bool = True) -> bool:
+    """
+    Refreshes the aggregated cache unless it is already fresh.
+    wait_for_leader applies to a refresh started by this call (see refresh_from_redis).
+    Single-flight per worker: while a refresh is running, every caller awaits that same
+    refresh and shares its result (success or failure), so upstream APIs are hit once
+    per expiry rather than once per waiting client.
+    Returns True if the cache holds fresh data afterwards.
+    """
+    task = app.state.refresh_task
+    if task is None or task.done():
+        if is_cache_fresh(time.time()):
+            return True
+        task = asyncio.ensure_future(run_refresh(app, wait_for_leader))
+        app.state.refresh_task = task
+    # Shielded so a caller that goes away does not cancel the refresh for the others
+    return await asyncio.shield(task)
+
+
+async def refresh_loop(app: FastAPI):
+    """Background task: keeps the cache warm so request handlers only read from it."""
+    while True:
+        try:
+            refreshed = await refresh_aggregated_data(app)
+        except Exception:
+            # Keep the refresher alive whatever happens; the traceback is logged once per failure
+            logger.exception("Background refresh crashed")
+            refreshed = False
+        if refreshed:
+            # Wake up when the cache expires (earlier than CACHE_DURATION_SECONDS for data read from Redis)
+            delay = CACHE_DURATION_SECONDS - (time.time() - data_cache["last_updated"])
+            await asyncio.sleep(max(delay, 1))
+        else:
+            await asyncio.sleep(CACHE_RETRY_SECONDS)
+
 # =================================================================
 #                       MAIN ENDPOINT (CACHING)
 # =================================================================
 
 @app.get(
     "/api/market/aggregated_data", 
-    response_model=Dict[str, Any],
+    # The payload is pre-serialized at refresh time and returned as-is, skipping response_model validation
+    response_class=Response,
     summary="Get Cached Aggregated Investment Data",
     # 🛡️ Endpoint requires 'X-API-Key' header
     dependencies=[Depends(verify_api_key)] 
 )
-async def get_cached_aggregated_investment_data():
-    global data_cache
-    current_time = time.time()
-    
-    # 1. CACHE CHECK
-    if (current_time - data_cache["last_updated"] < CACHE_DURATION_SECONDS) and data_cache["data"]:
-        print(f"LOG: Serving data from cache. Last updated at {time.strftime('%H:%M:%S', time.localtime(data_cache['last_updated']))}")
-        return data_cache["data"]
-    
-    # 2. DATA REFRESH
-    print(f"LOG: Cache expired or empty. Refreshing data from external APIs...")
-    
-    async with httpx.AsyncClient() as client:
-        # Run both requests in parallel
-        coingecko_data, bybit_data = await asyncio.gather(
-            fetch_coingecko_data(client),
-            fetch_bybit_spot_tickers(client)
-        )
-
-    # 3. AGGREGATION
-    final_data = aggregate_data(coingecko_data, bybit_data)
-
-    # 4. CACHE STORAGE
-    if final_data:
-        data_cache["data"] = final_data
-        data_cache["last_updated"] = current_time
-        print(f"LOG: Cache successfully updated at {time.strftime('%H:%M:%S', time.localtime(current_time))}. Total coins: {len(final_data)}")
-        return final_data
-    else:
-        # If refresh failed, but old data exists, it's better to return it
-        if data_cache["data"]:
-            print("LOG: Failed to refresh. Serving stale data from cache.")
-            return data_cache["data"]
-            
-        # If neither new nor old data is available
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Could not fetch data from external APIs and cache is empty."
-        )
+async def get_cached_aggregated_investment_data(request: Request):
+    # 1. CACHE CHECK (kept warm by the background refresher)
+    if data_cache["payload"]:
+        return cached_payload_response(request)
+
+    # 2. COLD START: no data yet. Join the in-progress refresh (single-flight) for at most
+    #    COLD_START_WAIT_SECONDS, unless one failed less than CACHE_RETRY_SECONDS ago:
+    #    the background refresher retries (and waits on other workers) on its own.
+    if time.time() - data_cache["last_failed"] >= CACHE_RETRY_SECONDS:
+        try:
+            await asyncio.wait_for(
+                refresh_aggregated_data(request.app, wait_for_leader=False),
+                timeout=COLD_START_WAIT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            pass
+    if data_cache["payload"]:
+        return cached_payload_response(request)
+
+    # If neither new nor old data is available
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Could not fetch data from external APIs and cache is empty."
+    )
 
 # =================================================================
 #                         NEW ENDPOINT: KLINES (CANDLESTICKS)
@@ -255,18 +732,20 @@ async def get_cached_aggregated_investment_data():
 
 @app.get(
     "/api/market/klines", 
-    # Bybit returns List[List[str]], so we specify this as the model
-    response_model=List[List[str]],
+    # Payloads are serialized once (and cached), so no response_model validation pass
+    response_class=Response,
     summary="Get Candlestick Data (OHLCV) for a specific symbol",
     # 🛡️ Endpoint is protected by API key
     dependencies=[Depends(verify_api_key)] 
 )
 async def get_klines(
+    request: Request,
     symbol: str, 
     interval: str, 
     start_time: int = None, 
     end_time: int = None,
-    limit: int = 1000 # Limit the maximum number of candles
+    limit: int = 1000, # Limit the maximum number of candles
+    format: Literal["rows", "columnar"] = "rows"
 ):
     """
     Fetches historical candlestick data (OHLCV) from Bybit.
@@ -276,7 +755,9 @@ async def get_klines(
     :param start_time: Start time in milliseconds (Unix timestamp * 1000)
     :param end_time: End time in milliseconds (Unix timestamp * 1000)
     :param limit: Maximum number of candles (up to 1000)
-    :return: List of lists [timestamp, open, high, low, close, volume, turnover]
+    :param format: 'rows' (Bybit layout) or 'columnar' (one numeric array per column)
+    :return: List of lists [timestamp, open, high, low, close, volume, turnover],
+             or {"ts": [...], "open": [...], ...} of floats for format=columnar
     """
     
     # Check for required parameters
@@ -286,18 +767,54 @@ async def get_klines(
             detail="Symbol and interval are required query parameters."
         )
 
-    async with httpx.AsyncClient() as client:
-        klines = await fetch_bybit_klines(client, symbol, interval, start_time, end_time, limit)
-
-    if not klines:
-        # If the API returned an empty list, report a 404 error
+    # Reject malformed parameters here instead of spending an upstream round trip on them
+    symbol = symbol.upper()
+    if not SYMBOL_PATTERN.match(symbol):
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No kline data found for {symbol} at interval {interval}. Check symbol and interval validity."
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid symbol. Expected an alphanumeric trading pair such as BTCUSDT."
+        )
+    if interval not in KLINE_INTERVALS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid interval. Allowed values: {', '.join(KLINE_INTERVAL_MS)}."
+        )
+    if not 1 <= limit <= KLINE_MAX_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid limit. Must be between 1 and {KLINE_MAX_LIMIT}."
         )
-        
-    return klines
 
+    # Serve identical requests from the kline cache: one entry per upstream request,
+    # holding every format pre-serialized
+    cache_key = (symbol, interval, start_time, end_time, limit)
+    cache = select_kline_cache(interval, end_time)
+    payloads = cache.get(cache_key)
+    if payloads is None:
+        client = request.app.state.client
+        klines = await fetch_bybit_klines(client, symbol, interval, start_time, end_time, limit)
 
-#if __name__ == "__main__":
-#    uvicorn.run("market_data_service:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+        if not klines:
+            # If the API returned an empty list, report a 404 error
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No kline data found for {symbol} at interval {interval}. Check symbol and interval validity."
+            )
+
+        payloads = serialize_klines(klines)
+        cache[cache_key] = payloads
+
+    return Response(content=payloads[format], media_type="application/json")
+
+
+if __name__ == "__main__":
+    # httptools (C HTTP parser) and uvloop ship with uvicorn[standard]; one worker per core by default.
+    # Each worker keeps its own in-memory cache and background refresher.
+    uvicorn.run(
+        "market_data_service:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1)),
+        loop="uvloop" if uvloop else "asyncio",
+        http="httptools"
+    )
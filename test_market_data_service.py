@@ -0,0 +1,377 @@
+import asyncio
+
+import httpx
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+import market_data_service as service
+
+API_KEY = "test-key"
+KLINE_ROWS = [
+    [str(1_700_000_000_000 + i * 60_000), "1.5", "2", "0.5", "1.75", "10", "17.5"]
+    for i in range(300)
+]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(service, "data_cache", {
+        "last_updated": 0,
+        "last_failed": 0,
+        "payload": b"",
+        "encoded": {},
+        "etag": "",
+        "last_modified": "",
+    })
+    monkeypatch.setattr(service, "UPSTREAM_BACKOFF_SECONDS", 0)
+    service.kline_live_cache.clear()
+    service.kline_history_cache.clear()
+
+
+def mock_client(handler):
+    """An httpx client whose requests are answered by handler and counted in client.calls."""
+    calls = []
+
+    def counting_handler(request):
+        calls.append(request.url)
+        return handler(request)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(counting_handler))
+    client.calls = calls
+    return client
+
+
+def bybit_klines(request):
+    return httpx.Response(200, json={"retCode": 0, "result": {"list": KLINE_ROWS}})
+
+
+def use_upstream(monkeypatch, upstream):
+    """Points the app at a mocked upstream client without running the lifespan."""
+    monkeypatch.setattr(service.app.state, "client", upstream, raising=False)
+    monkeypatch.setattr(service.app.state, "redis", None, raising=False)
+    monkeypatch.setattr(service.app.state, "refresh_task", None, raising=False)
+    monkeypatch.setattr(service, "API_KEY_BYTES", API_KEY.encode())
+
+
+async def get_concurrently(path, count, headers=None):
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(
+            *(client.get(path, headers={"X-API-Key": API_KEY, **(headers or {})}) for _ in range(count))
+        )
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def no_refresh(app):
+        pass
+
+    async def fake_klines(client, symbol, interval, start_time=None, end_time=None, limit=1000):
+        return rows
+
+    rows = [list(row) for row in KLINE_ROWS]
+    monkeypatch.setattr(service, "API_KEY_BYTES", API_KEY.encode())
+    monkeypatch.setattr(service, "refresh_loop", no_refresh)
+    monkeypatch.setattr(service, "fetch_bybit_klines", fake_klines)
+    with TestClient(service.app) as test_client:
+        test_client.rows = rows
+        yield test_client
+
+
+def test_klines_to_columns_serializes_with_orjson():
+    columns = service.klines_to_columns(KLINE_ROWS[:2])
+    decoded = orjson.loads(orjson.dumps(columns, option=orjson.OPT_SERIALIZE_NUMPY))
+    assert list(decoded) == list(service.KLINE_COLUMNS)
+    assert decoded["ts"] == [1_700_000_000_000.0, 1_700_000_060_000.0]
+    assert decoded["close"] == [1.75, 1.75]
+
+
+def test_klines_to_columns_maps_malformed_values_to_nan():
+    columns = service.klines_to_columns([["1", "", "2", "0.5", "1.5", "10", "15"], ["2", "1"]])
+    assert columns["ts"].tolist() == [1.0, 2.0]
+    assert columns["open"][1] == 1.0
+    assert all(columns[name][1] != columns[name][1] for name in service.KLINE_COLUMNS[2:])
+    assert columns["open"][0] != columns["open"][0]
+
+
+def test_get_klines_columnar(client):
+    response = client.get(
+        "/api/market/klines",
+        params={"symbol": "BTCUSDT", "interval": "1", "format": "columnar"},
+        headers={"X-API-Key": API_KEY},
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["ts"]) == len(KLINE_ROWS)
+    assert body["high"][0] == 2.0
+    assert body["turnover"][-1] == 17.5
+
+
+def test_get_klines_columnar_with_malformed_row(client):
+    client.rows[5][4] = ""
+    response = client.get(
+        "/api/market/klines",
+        params={"symbol": "BTCUSDT", "interval": "1", "format": "columnar"},
+        headers={"X-API-Key": API_KEY},
+    )
+    assert response.status_code == 200
+    assert response.json()["close"][5] is None  # NaN serializes as null
+
+
+def test_cold_start_requests_share_one_failed_refresh(monkeypatch):
+    upstream = mock_client(lambda request: httpx.Response(503))
+    use_upstream(monkeypatch, upstream)
+
+    responses = asyncio.run(get_concurrently("/api/market/aggregated_data", 20))
+
+    assert [r.status_code for r in responses] == [503] * 20
+    # One refresh: every page and the tickers endpoint, each tried 1 + UPSTREAM_RETRIES times
+    assert len(upstream.calls) == (service.COINGECKO_PAGES + 1) * (service.UPSTREAM_RETRIES + 1)
+
+    # A failure less than CACHE_RETRY_SECONDS old is answered without another upstream attempt
+    responses = asyncio.run(get_concurrently("/api/market/aggregated_data", 5))
+    assert [r.status_code for r in responses] == [503] * 5
+    assert len(upstream.calls) == (service.COINGECKO_PAGES + 1) * (service.UPSTREAM_RETRIES + 1)
+
+
+def test_cold_start_with_redis_does_not_wait_for_another_workers_refresh(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    upstream = mock_client(lambda request: httpx.Response(503))
+    use_upstream(monkeypatch, upstream)
+    redis = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(service.app.state, "redis", redis)
+
+    async def scenario():
+        # Another worker holds the refresh lock and has not published a payload yet
+        await redis.set(service.REDIS_LOCK_KEY, "1", ex=service.REDIS_LOCK_SECONDS)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        responses = await get_concurrently("/api/market/aggregated_data", 6)
+        return responses, loop.time() - started
+
+    responses, elapsed = asyncio.run(scenario())
+
+    assert [r.status_code for r in responses] == [503] * 6
+    assert elapsed < 1
+    assert upstream.calls == []
+
+
+def test_cold_start_with_redis_serves_the_shared_payload(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    upstream = mock_client(lambda request: httpx.Response(503))
+    use_upstream(monkeypatch, upstream)
+    redis = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(service.app.state, "redis", redis)
+    payload = orjson.dumps({"BTCUSDT": {"coinName": "Bitcoin", "currentPrice": "100"}})
+
+    async def scenario():
+        await redis.set(service.REDIS_CACHE_KEY, payload, ex=service.CACHE_DURATION_SECONDS)
+        return await get_concurrently("/api/market/aggregated_data", 3, {"Accept-Encoding": "identity"})
+
+    responses = asyncio.run(scenario())
+
+    assert [r.content for r in responses] == [payload] * 3
+    assert upstream.calls == []
+
+
+def test_get_klines_formats_share_one_upstream_request(monkeypatch):
+    upstream = mock_client(bybit_klines)
+    use_upstream(monkeypatch, upstream)
+    client = TestClient(service.app)
+    params = {"symbol": "BTCUSDT", "interval": "1", "limit": 300}
+
+    rows = client.get("/api/market/klines", params=params, headers={"X-API-Key": API_KEY})
+    columnar = client.get("/api/market/klines", params={**params, "format": "columnar"}, headers={"X-API-Key": API_KEY})
+
+    assert rows.json() == KLINE_ROWS
+    assert columnar.json()["close"] == [1.75] * len(KLINE_ROWS)
+    assert len(upstream.calls) == 1
+
+
+@pytest.mark.parametrize("end_time, expected_cache", [
+    (1_700_000_000_000, "kline_history_cache"),  # long closed
+    (None, "kline_live_cache"),
+    ("now", "kline_live_cache"),  # last candle still forming
+])
+def test_get_klines_caches_by_range_state(monkeypatch, end_time, expected_cache):
+    upstream = mock_client(bybit_klines)
+    use_upstream(monkeypatch, upstream)
+    client = TestClient(service.app)
+    if end_time == "now":
+        end_time = int(service.time.time() * 1000)
+    params = {"symbol": "BTCUSDT", "interval": "60", "limit": 300}
+    if end_time is not None:
+        params["end_time"] = end_time
+
+    first = client.get("/api/market/klines", params=params, headers={"X-API-Key": API_KEY})
+    second = client.get("/api/market/klines", params=params, headers={"X-API-Key": API_KEY})
+
+    assert first.status_code == second.status_code == 200
+    assert second.content == first.content
+    assert len(upstream.calls) == 1
+    key = ("BTCUSDT", "60", None, end_time, 300)
+    assert key in getattr(service, expected_cache)
+    other_cache = {"kline_history_cache", "kline_live_cache"} - {expected_cache}
+    assert key not in getattr(service, other_cache.pop())
+
+
+def test_kline_cache_is_bounded_by_payload_bytes():
+    payloads = service.serialize_klines(KLINE_ROWS)
+    entry_size = service.kline_payloads_size(payloads)
+    for end_time in range(service.KLINE_HISTORY_CACHE_BYTES // entry_size + 10):
+        service.kline_history_cache[("BTCUSDT", "1", None, end_time, 300)] = payloads
+
+    assert service.kline_history_cache.currsize <= service.KLINE_HISTORY_CACHE_BYTES
+    assert len(service.kline_history_cache) == service.KLINE_HISTORY_CACHE_BYTES // entry_size
+
+
+@pytest.mark.parametrize("body", [
+    {"retCode": 0, "result": []},
+    {"retCode": 0, "result": {"list": "not-a-list"}},
+    {"retCode": 0},
+    {"retCode": 10001, "retMsg": "params error"},
+    ["not", "an", "object"],
+])
+def test_get_klines_malformed_upstream_body_is_404(monkeypatch, body):
+    use_upstream(monkeypatch, mock_client(lambda request: httpx.Response(200, json=body)))
+    client = TestClient(service.app)
+
+    response = client.get(
+        "/api/market/klines", params={"symbol": "BTCUSDT", "interval": "1"}, headers={"X-API-Key": API_KEY}
+    )
+
+    assert response.status_code == 404
+
+
+def test_fetch_bybit_klines_coalesces_identical_requests():
+    upstream = mock_client(bybit_klines)
+
+    async def scenario():
+        return await asyncio.gather(*(service.fetch_bybit_klines(upstream, "BTCUSDT", "1") for _ in range(10)))
+
+    results = asyncio.run(scenario())
+
+    assert results == [KLINE_ROWS] * 10
+    assert len(upstream.calls) == 1
+    assert service.kline_inflight == {}
+
+
+def test_fetch_bybit_klines_shares_exceptions_with_every_caller():
+    def broken(request):
+        raise RuntimeError("upstream exploded")
+
+    upstream = mock_client(broken)
+
+    async def scenario():
+        return await asyncio.gather(
+            *(service.fetch_bybit_klines(upstream, "BTCUSDT", "1") for _ in range(5)), return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+
+    assert [type(result) for result in results] == [RuntimeError] * 5
+    assert len(upstream.calls) == 1
+    assert service.kline_inflight == {}
+
+
+def test_get_klines_rejects_bad_symbol_before_upstream(monkeypatch):
+    upstream = mock_client(bybit_klines)
+    use_upstream(monkeypatch, upstream)
+    client = TestClient(service.app)
+
+    response = client.get(
+        "/api/market/klines", params={"symbol": "btc-usdt", "interval": "1"}, headers={"X-API-Key": API_KEY}
+    )
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid symbol. Expected an alphanumeric trading pair such as BTCUSDT."
+    assert upstream.calls == []
+
+
+AGGREGATED = {
+    f"COIN{i}USDT": {"coinName": f"Coin {i}", "currentPrice": "1.5", "marketCapUSD": None} for i in range(100)
+}
+
+
+@pytest.fixture
+def aggregated_client(monkeypatch):
+    """A client whose aggregated cache was just refreshed, without brotli available."""
+    monkeypatch.setattr(service, "brotli", None)
+    use_upstream(monkeypatch, mock_client(lambda request: httpx.Response(503)))
+    service.store_payload(orjson.dumps(AGGREGATED), service.time.time())
+    return TestClient(service.app)
+
+
+def get_aggregated(client, **headers):
+    return client.get("/api/market/aggregated_data", headers={"X-API-Key": API_KEY, **headers})
+
+
+def test_aggregated_data_cache_headers(aggregated_client):
+    response = get_aggregated(aggregated_client, **{"Accept-Encoding": "identity"})
+
+    assert response.status_code == 200
+    assert response.content == orjson.dumps(AGGREGATED)
+    assert response.headers["etag"] == service.data_cache["etag"]
+    assert response.headers["last-modified"] == service.data_cache["last_modified"]
+    cache_control = response.headers["cache-control"]
+    assert cache_control.startswith("private, max-age=")
+    assert 0 <= int(cache_control.rpartition("=")[2]) <= service.CACHE_DURATION_SECONDS
+    assert "content-encoding" not in response.headers
+
+
+@pytest.mark.parametrize("if_none_match", [
+    "{etag}",
+    "{opaque}",  # strong form of the same tag
+    "*",
+    '"other", {etag}',
+])
+def test_aggregated_data_not_modified(aggregated_client, if_none_match):
+    etag = service.data_cache["etag"]
+    header = if_none_match.format(etag=etag, opaque=etag[2:])
+
+    response = get_aggregated(aggregated_client, **{"If-None-Match": header})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert response.headers["cache-control"].startswith("private, max-age=")
+    assert response.headers["vary"].startswith("Accept-Encoding")
+
+
+def test_aggregated_data_modified_etag_gets_body(aggregated_client):
+    response = get_aggregated(aggregated_client, **{"If-None-Match": 'W/"stale", "also-stale"'})
+
+    assert response.status_code == 200
+    assert response.json() == AGGREGATED
+
+
+@pytest.mark.parametrize("accept_encoding, expected_encoding", [
+    ("gzip", "gzip"),
+    ("br, gzip;q=0.8", "gzip"),  # brotli unavailable: falls back to gzip
+    ("gzip;q=0", None),
+    ("GZIP ; q=1.0, deflate", "gzip"),
+    ("identity", None),
+])
+def test_aggregated_data_content_encoding(aggregated_client, accept_encoding, expected_encoding):
+    response = get_aggregated(aggregated_client, **{"Accept-Encoding": accept_encoding})
+
+    assert response.status_code == 200
+    assert response.headers.get("content-encoding") == expected_encoding
+    assert response.json() == AGGREGATED  # httpx decodes gzip transparently
+
+
+@pytest.mark.parametrize("accept_encoding, expected_encoding", [("gzip", "gzip"), ("gzip;q=0", None)])
+def test_get_klines_compression_honours_accept_encoding(monkeypatch, accept_encoding, expected_encoding):
+    use_upstream(monkeypatch, mock_client(bybit_klines))
+    client = TestClient(service.app)
+
+    response = client.get(
+        "/api/market/klines",
+        params={"symbol": "BTCUSDT", "interval": "1"},
+        headers={"X-API-Key": API_KEY, "Accept-Encoding": accept_encoding},
+    )
+
+    assert response.status_code == 200
+    assert response.headers.get("content-encoding") == expected_encoding
+    assert response.json() == KLINE_ROWS